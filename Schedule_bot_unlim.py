@@ -1,15 +1,27 @@
-import json
+import asyncio
+import contextlib
+import functools
+import logging
+import logging.handlers
 import os
+import queue
+import re
+import sqlite3
+import sys
+import threading
 import warnings
+from collections import OrderedDict
 from pathlib import Path
-from typing import Dict, List, Any
+from typing import Any, Awaitable, Dict, Iterable, List, Optional, Set, Tuple
 
+import orjson
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.error import BadRequest
 from telegram.warnings import PTBUserWarning
 from telegram.ext import (
     ApplicationBuilder,
+    BaseUpdateProcessor,
     CallbackQueryHandler,
     CommandHandler,
     ContextTypes,
@@ -24,17 +36,36 @@ from telegram.ext import (
 warnings.filterwarnings("ignore", category=PTBUserWarning)
 
 # =========================
-# 1) Token from .env
+# 1) Logging
+# =========================
+# Логи кладутся в очередь, а в stderr их пишет поток QueueListener,
+# чтобы вывод не блокировал цикл событий.
+log = logging.getLogger("schedbot")
+_LOG_QUEUE: "queue.Queue[logging.LogRecord]" = queue.Queue(-1)
+_log_stream = logging.StreamHandler()
+_log_stream.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+_LOG_LISTENER = logging.handlers.QueueListener(_LOG_QUEUE, _log_stream)
+log.addHandler(logging.handlers.QueueHandler(_LOG_QUEUE))
+log.setLevel(logging.INFO)
+log.propagate = False
+
+# =========================
+# 2) Token from .env
 # =========================
 load_dotenv()
 TOKEN = os.getenv("BOT_TOKEN")
+# Базовый внешний адрес для вебхука (https://example.com). Без него — long polling.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+# Необязательный секрет: Telegram присылает его в заголовке X-Telegram-Bot-Api-Secret-Token.
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
 
 # =========================
-# 2) Schedule settings
+# 3) Schedule settings
 # =========================
+DB_FILE = Path("schedules.db")
 DATA_FILE = Path("schedules.json")
 
-WEEKDAYS = ["monday", "tuesday", "wednesday", "thursday", "friday"]
+WEEKDAYS = [sys.intern(d) for d in ("monday", "tuesday", "wednesday", "thursday", "friday")]
 WEEKDAY_RU = {
     "monday": "Понедельник",
     "tuesday": "Вторник",
@@ -43,9 +74,15 @@ WEEKDAY_RU = {
     "friday": "Пятница",
 }
 PAIR_COUNT = 4
+# Пустая пара: один общий объект строки на все ячейки всех пользователей.
+EMPTY = sys.intern("—")
+# Расписание пользователя хранится плоским списком из SLOT_COUNT строк:
+# пара slot дня day лежит в schedule[DAY_IDX[day] + slot].
+SLOT_COUNT = len(WEEKDAYS) * PAIR_COUNT
+DAY_IDX = {d: i * PAIR_COUNT for i, d in enumerate(WEEKDAYS)}
 
 # =========================
-# 3) Conversation states
+# 4) Conversation states
 # =========================
 (
     STATE_MENU,
@@ -58,136 +95,327 @@ PAIR_COUNT = 4
     STATE_EDIT_TEXT,
 ) = range(8)
 
+# Ключи context.user_data для выбранных дня и пары.
+K_BDAY = sys.intern("build_day")
+K_BSLOT = sys.intern("build_slot")
+K_EDAY = sys.intern("edit_day")
+K_ESLOT = sys.intern("edit_slot")
+
 
 # =========================
-# 4) Storage (multi-user JSON)
+# 5) Storage (multi-user SQLite)
 # =========================
-def default_schedule() -> Dict[str, List[str]]:
-    return {d: ["—"] * PAIR_COUNT for d in WEEKDAYS}
+def default_schedule() -> List[str]:
+    return [EMPTY] * SLOT_COUNT
+
 
+def _normalize_cell(value: Any) -> str:
+    # Значение из ручного schedules.json: null становится пустой парой,
+    # прочие не-строки — их строковым видом (колонка value — TEXT NOT NULL).
+    if value is None or value == EMPTY:
+        return EMPTY
+    return value if isinstance(value, str) else str(value)
 
-def _normalize_schedule(raw: Any) -> Dict[str, List[str]]:
+
+def _normalize_schedule(raw: Any) -> List[str]:
+    # Старый формат {day: [pairs]} разворачивается в плоский список.
     if not isinstance(raw, dict):
         raw = {}
-    out: Dict[str, List[str]] = {}
+    out: List[str] = []
     for d in WEEKDAYS:
         day_list = raw.get(d)
         if not isinstance(day_list, list):
-            day_list = ["—"] * PAIR_COUNT
-        out[d] = (day_list + ["—"] * PAIR_COUNT)[:PAIR_COUNT]
+            day_list = [EMPTY] * PAIR_COUNT
+        out.extend(_normalize_cell(v) for v in (day_list + [EMPTY] * PAIR_COUNT)[:PAIR_COUNT])
     return out
 
 
-def load_all() -> Dict[str, Dict[str, List[str]]]:
+# Кэш расписаний в памяти: расписание пользователя читается из базы
+# (поиск по первичному ключу) при первом обращении к нему, дальше обработчики
+# работают только со словарём. Изменённые ячейки (user, day, slot) сбрасывает
+# в SQLite фоновая задача _flusher не чаще раза в FLUSH_INTERVAL секунд.
+_CACHE: Dict[str, List[str]] = {}
+_DIRTY: Set[Tuple[str, str, int]] = set()
+# _DB пишет из потока flush (под _DB_LOCK), _DB_READ читает из потоков
+# asyncio.to_thread (под _DB_READ_LOCK); в режиме WAL чтение не ждёт записи.
+_DB: Optional[sqlite3.Connection] = None
+_DB_READ: Optional[sqlite3.Connection] = None
+_DB_LOCK = threading.Lock()
+_DB_READ_LOCK = threading.Lock()
+_FLUSH_TASK: Optional[asyncio.Task] = None
+_EMPTY_SCHEDULE = default_schedule()
+FLUSH_INTERVAL = 1.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS schedule (
+    user_id INTEGER NOT NULL,
+    day TEXT NOT NULL,
+    slot INTEGER NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (user_id, day, slot)
+)
+"""
+
+
+def load_all() -> Dict[str, Any]:
+    # Старый формат (schedules.json): читается только для переноса данных в базу.
     if not DATA_FILE.exists():
         return {}
     try:
-        with DATA_FILE.open("r", encoding="utf-8") as f:
-            data = json.load(f)
+        data = orjson.loads(DATA_FILE.read_bytes())
         return data if isinstance(data, dict) else {}
     except Exception:
         return {}
 
 
-def save_all(data: Dict[str, Dict[str, List[str]]]) -> None:
-    with DATA_FILE.open("w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+def _open_db() -> sqlite3.Connection:
+    db = sqlite3.connect(DB_FILE, isolation_level=None, check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute(_SCHEMA)
+    return db
 
 
-def get_user_schedule(user_id: int) -> Dict[str, List[str]]:
-    all_data = load_all()
-    key = str(user_id)
+def _read_user(key: str) -> Optional[List[str]]:
+    with _DB_READ_LOCK:
+        rows = _DB_READ.execute("SELECT day, slot, value FROM schedule WHERE user_id = ?", (int(key),)).fetchall()
+    if not rows:
+        return None
+    schedule = default_schedule()
+    for day, slot, value in rows:
+        if day in DAY_IDX and 0 <= slot < PAIR_COUNT:
+            schedule[DAY_IDX[day] + slot] = EMPTY if value == EMPTY else value
+    return schedule
+
+
+def _write_rows(rows: List[Tuple[int, str, int, str]]) -> None:
+    with _DB_LOCK:
+        if _DB is None:
+            # Запись из отменённого flush дошла после _close_db: строки уже
+            # вернулись в _DIRTY и сохранены финальным flush.
+            return
+        _DB.execute("BEGIN")
+        try:
+            _DB.executemany("INSERT OR REPLACE INTO schedule VALUES (?, ?, ?, ?)", rows)
+        except Exception:
+            _DB.execute("ROLLBACK")
+            raise
+        _DB.execute("COMMIT")
+
+
+def _mark_user_dirty(key: str) -> None:
+    _DIRTY.update((key, d, i) for d in WEEKDAYS for i in range(PAIR_COUNT))
+
+
+def _ensure_db() -> None:
+    global _DB, _DB_READ
+    if _DB is not None:
+        return
+    _DB = _open_db()
+    _DB_READ = _open_db()
+    if _DB.execute("SELECT 1 FROM schedule LIMIT 1").fetchone() is None:
+        # Первый запуск на SQLite: переносим расписания из schedules.json.
+        legacy = {key: _normalize_schedule(raw) for key, raw in load_all().items() if key.isdigit()}
+        _write_rows([
+            (int(key), d, i, schedule[DAY_IDX[d] + i])
+            for key, schedule in legacy.items()
+            for d in WEEKDAYS
+            for i in range(PAIR_COUNT)
+        ])
+
+
+def _close_db() -> None:
+    # Закрытие последнего соединения сбрасывает WAL в базу и удаляет -wal/-shm.
+    global _DB, _DB_READ
+    with _DB_LOCK, _DB_READ_LOCK:
+        for db in (_DB_READ, _DB):
+            if db is not None:
+                db.close()
+        _DB = _DB_READ = None
+
+
+async def _cached_user(key: str) -> List[str]:
+    # Промах тоже кэшируется: пользователь без строк в базе получает общий
+    # _EMPTY_SCHEDULE, и повторные клики больше не ходят в SQLite.
+    schedule = _CACHE.get(key)
+    if schedule is None:
+        _ensure_db()
+        loaded = await asyncio.to_thread(_read_user, key)
+        schedule = _CACHE.setdefault(key, loaded or _EMPTY_SCHEDULE)
+    return schedule
+
+
+async def flush() -> None:
+    if not _DIRTY:
+        return
+    # Снимок строк собираем в цикле событий (он согласован), пишем в отдельном потоке.
+    rows = [(int(key), day, slot, _CACHE[key][DAY_IDX[day] + slot]) for key, day, slot in _DIRTY]
+    _DIRTY.clear()
+    try:
+        await asyncio.to_thread(_write_rows, rows)
+    except BaseException:
+        # В том числе при отмене задачи: строки вернутся в очередь на запись.
+        _DIRTY.update((str(user_id), day, slot) for user_id, day, slot, _ in rows)
+        raise
 
-    if key not in all_data:
-        all_data[key] = default_schedule()
-        save_all(all_data)
-        return all_data[key]
 
-    all_data[key] = _normalize_schedule(all_data[key])
-    save_all(all_data)
-    return all_data[key]
+async def _flusher() -> None:
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        try:
+            await flush()
+        except Exception:
+            log.exception("Flush error")
 
 
-def set_user_schedule(user_id: int, schedule: Dict[str, List[str]]) -> None:
-    all_data = load_all()
+async def _get_user_schedule_readonly(user_id: int) -> List[str]:
+    # Только чтение: новый пользователь получает _EMPTY_SCHEDULE и в _DIRTY не попадает.
+    return await _cached_user(str(user_id))
+
+
+async def _ensure_user(user_id: int) -> List[str]:
     key = str(user_id)
-    all_data[key] = _normalize_schedule(schedule)
-    save_all(all_data)
+    schedule = await _cached_user(key)
 
+    if schedule is _EMPTY_SCHEDULE:
+        schedule = _CACHE[key] = default_schedule()
+        _mark_user_dirty(key)
+    return schedule
 
-def set_user_day_slot(user_id: int, day: str, slot_index: int, value: str) -> Dict[str, List[str]]:
-    schedule = get_user_schedule(user_id)
-    schedule[day][slot_index] = value if value else "—"
-    set_user_schedule(user_id, schedule)
+
+async def set_user_day_slot(user_id: int, day: str, slot_index: int, value: str) -> List[str]:
+    schedule = await _ensure_user(user_id)
+    schedule[DAY_IDX[day] + slot_index] = value if value and value != EMPTY else EMPTY
+    _DIRTY.add((str(user_id), day, slot_index))
     return schedule
 
 
 # =========================
-# 5) UI keyboards
+# 6) UI keyboards
 # =========================
-def kb_menu() -> InlineKeyboardMarkup:
+# callback_data всех кнопок заранее собраны и интернированы; обратные таблицы
+# _DAY_BY_CB/_SLOT_BY_CB разбирают входящие данные одним поиском в словаре.
+CB_MENU_BACK = sys.intern("menu:back")
+CB_MENU_VIEW = sys.intern("menu:view")
+CB_MENU_BUILD = sys.intern("menu:build")
+CB_MENU_EDIT = sys.intern("menu:edit")
+CB_DAYS = {
+    prefix: {d: sys.intern(f"{prefix}:{d}") for d in WEEKDAYS}
+    for prefix in ("viewday", "buildday", "editday")
+}
+CB_SLOTS = {
+    prefix: {(d, i): sys.intern(f"{prefix}:{d}:{i}") for d in WEEKDAYS for i in range(PAIR_COUNT)}
+    for prefix in ("buildslot", "editslot")
+}
+CB_SLOTS_BACK = {
+    prefix: {d: sys.intern(f"{prefix}:back:{d}") for d in WEEKDAYS}
+    for prefix in ("buildslot", "editslot")
+}
+_DAY_BY_CB = {cb: d for days in CB_DAYS.values() for d, cb in days.items()}
+_SLOT_BY_CB = {cb: key for slots in CB_SLOTS.values() for key, cb in slots.items()}
+
+
+# Клавиатуры не зависят от пользователя, поэтому все они (их всего 20)
+# собираются один раз при импорте и переиспользуются во всех ответах.
+def _build_menu() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(
         [
-            [InlineKeyboardButton("Узнать расписание", callback_data="menu:view")],
-            [InlineKeyboardButton("Составить расписание", callback_data="menu:build")],
-            [InlineKeyboardButton("Редактировать расписание", callback_data="menu:edit")],
+            [InlineKeyboardButton("Узнать расписание", callback_data=CB_MENU_VIEW)],
+            [InlineKeyboardButton("Составить расписание", callback_data=CB_MENU_BUILD)],
+            [InlineKeyboardButton("Редактировать расписание", callback_data=CB_MENU_EDIT)],
         ]
     )
 
 
-def kb_weekdays(prefix: str) -> InlineKeyboardMarkup:
-    rows = [[InlineKeyboardButton(WEEKDAY_RU[d], callback_data=f"{prefix}:{d}")] for d in WEEKDAYS]
-    rows.append([InlineKeyboardButton("Меню", callback_data="menu:back")])
+def _build_weekdays(prefix: str) -> InlineKeyboardMarkup:
+    rows = [[InlineKeyboardButton(WEEKDAY_RU[d], callback_data=CB_DAYS[prefix][d])] for d in WEEKDAYS]
+    rows.append([InlineKeyboardButton("Меню", callback_data=CB_MENU_BACK)])
     return InlineKeyboardMarkup(rows)
 
 
-def kb_slots(prefix: str, day: str) -> InlineKeyboardMarkup:
-    rows = [[InlineKeyboardButton(f"{i+1} пара", callback_data=f"{prefix}:{day}:{i}")]
+def _build_slots(prefix: str, day: str) -> InlineKeyboardMarkup:
+    rows = [[InlineKeyboardButton(f"{i+1} пара", callback_data=CB_SLOTS[prefix][day, i])]
             for i in range(PAIR_COUNT)]
-    rows.append([InlineKeyboardButton("Назад", callback_data=f"{prefix}:back:{day}")])
-    rows.append([InlineKeyboardButton("Меню", callback_data="menu:back")])
+    rows.append([InlineKeyboardButton("Назад", callback_data=CB_SLOTS_BACK[prefix][day])])
+    rows.append([InlineKeyboardButton("Меню", callback_data=CB_MENU_BACK)])
     return InlineKeyboardMarkup(rows)
 
 
-def kb_back_to_menu() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([[InlineKeyboardButton("Меню", callback_data="menu:back")]])
+def _build_back_to_menu() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[InlineKeyboardButton("Меню", callback_data=CB_MENU_BACK)]])
+
+
+KB_MENU = _build_menu()
+KB_BACK = _build_back_to_menu()
+KB_WEEKDAYS = {prefix: _build_weekdays(prefix) for prefix in CB_DAYS}
+KB_SLOTS = {
+    (prefix, day): _build_slots(prefix, day)
+    for prefix in CB_SLOTS
+    for day in WEEKDAYS
+}
 
 
 # =========================
-# 6) Helpers (safe edit)
+# 7) Helpers (safe edit)
 # =========================
+# Последний отправленный текст и клавиатура для (chat_id, message_id):
+# повторный клик, который не меняет сообщение, не вызывает Bot API вовсе.
+_LAST_SENT: "OrderedDict[Tuple[int, int], Tuple[str, Any]]" = OrderedDict()
+LAST_SENT_MAXLEN = 4096
+
+
 async def safe_edit_message(query, text: str, reply_markup=None) -> None:
+    message = query.message
+    key = (message.chat_id, message.message_id) if message is not None else None
+    if key is not None:
+        last = _LAST_SENT.get(key)
+        if last is not None and last[0] == text and last[1] is reply_markup:
+            _LAST_SENT.move_to_end(key)
+            return
+
     try:
         await query.edit_message_text(text, reply_markup=reply_markup)
     except BadRequest as e:
-        if "Message is not modified" in str(e):
-            return
-        raise
+        if "Message is not modified" not in str(e):
+            raise
+
+    if key is not None:
+        _LAST_SENT[key] = (text, reply_markup)
+        _LAST_SENT.move_to_end(key)
+        if len(_LAST_SENT) > LAST_SENT_MAXLEN:
+            _LAST_SENT.popitem(last=False)
 
 
 # =========================
-# 7) Formatting
+# 8) Formatting
 # =========================
-def format_day(schedule: Dict[str, List[str]], day: str) -> str:
-    pairs = schedule.get(day, ["—"] * PAIR_COUNT)
-    lines = [f"📅 {WEEKDAY_RU[day]}"]
-    for idx, item in enumerate(pairs, start=1):
-        lines.append(f"{idx}) {item}")
-    lines.append("")
-    lines.append("Суббота и воскресенье — выходной.")
-    return "\n".join(lines)
+_DAY_TEMPLATE = (
+    "📅 {hdr}\n"
+    + "\n".join(f"{i + 1}) {{{i}}}" for i in range(PAIR_COUNT))
+    + "\n\nСуббота и воскресенье — выходной."
+)
+
+
+@functools.lru_cache(maxsize=4096)
+def _format_day_cached(day: str, pairs: Tuple[str, ...]) -> str:
+    return _DAY_TEMPLATE.format(*pairs, hdr=WEEKDAY_RU[day])
+
+
+def format_day(schedule: List[str], day: str) -> str:
+    start = DAY_IDX[day]
+    return _format_day_cached(day, tuple(schedule[start:start + PAIR_COUNT]))
 
 
 # =========================
-# 8) Commands
+# 9) Commands
 # =========================
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_id = update.effective_user.id
-    _ = get_user_schedule(user_id)
+    await _ensure_user(user_id)
 
     await update.message.reply_text(
         "Меню.\nУ каждого пользователя своё расписание (Пн–Пт, 4 пары).",
-        reply_markup=kb_menu(),
+        reply_markup=KB_MENU,
     )
     return STATE_MENU
 
@@ -197,190 +425,269 @@ async def cmd_help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         "Команды:\n/start — меню\n/help — помощь\n\n"
         "Расписание персональное для каждого пользователя.\n"
         "Пн–Пт: 4 пары. Сб/Вс: выходной.",
-        reply_markup=kb_menu(),
+        reply_markup=KB_MENU,
     )
 
 
 # =========================
-# 9) Menu router
+# 10) Menu router
 # =========================
-async def on_menu_click(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    query = update.callback_query
-    await query.answer()
-    data = query.data
-
-    if data == "menu:back":
-        await safe_edit_message(query, "Меню:", reply_markup=kb_menu())
-        return STATE_MENU
-
-    if data == "menu:view":
-        await safe_edit_message(query, "Выберите день (Пн–Пт):", reply_markup=kb_weekdays("viewday"))
-        return STATE_VIEW_DAY
+_MENU_ACTIONS = {
+    CB_MENU_BACK: ("Меню:", KB_MENU, STATE_MENU),
+    CB_MENU_VIEW: ("Выберите день (Пн–Пт):", KB_WEEKDAYS["viewday"], STATE_VIEW_DAY),
+    CB_MENU_BUILD: ("Составление. Выберите день (Пн–Пт):", KB_WEEKDAYS["buildday"], STATE_BUILD_DAY),
+    CB_MENU_EDIT: ("Редактирование. Выберите день (Пн–Пт):", KB_WEEKDAYS["editday"], STATE_EDIT_DAY),
+}
 
-    if data == "menu:build":
-        await safe_edit_message(query, "Составление. Выберите день (Пн–Пт):", reply_markup=kb_weekdays("buildday"))
-        return STATE_BUILD_DAY
 
-    if data == "menu:edit":
-        await safe_edit_message(query, "Редактирование. Выберите день (Пн–Пт):", reply_markup=kb_weekdays("editday"))
-        return STATE_EDIT_DAY
+async def on_menu_click(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    context.application.create_task(query.answer(), update=update)
 
-    await safe_edit_message(query, "Меню:", reply_markup=kb_menu())
-    return STATE_MENU
+    text, markup, state = _MENU_ACTIONS.get(query.data, _MENU_ACTIONS[CB_MENU_BACK])
+    await safe_edit_message(query, text, reply_markup=markup)
+    return state
 
 
 # =========================
-# 10) View
+# 11) View
 # =========================
 async def on_view_day(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
-    await query.answer()
+    context.application.create_task(query.answer(), update=update)
 
-    _, day = query.data.split(":", 1)
+    day = _DAY_BY_CB[query.data]
     user_id = query.from_user.id
-    schedule = get_user_schedule(user_id)
+    schedule = await _get_user_schedule_readonly(user_id)
 
-    await safe_edit_message(query, format_day(schedule, day), reply_markup=kb_back_to_menu())
+    await safe_edit_message(query, format_day(schedule, day), reply_markup=KB_BACK)
     return STATE_MENU
 
 
 # =========================
-# 11) Build
+# 12) Build
 # =========================
 async def on_build_day(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
-    await query.answer()
+    context.application.create_task(query.answer(), update=update)
 
-    _, day = query.data.split(":", 1)
-    context.user_data["build_day"] = day
+    day = _DAY_BY_CB[query.data]
+    context.user_data[K_BDAY] = day
 
     user_id = query.from_user.id
-    schedule = get_user_schedule(user_id)
+    schedule = await _get_user_schedule_readonly(user_id)
 
     text = format_day(schedule, day) + "\n\nВыберите, какую пару заполнить:"
-    await safe_edit_message(query, text, reply_markup=kb_slots("buildslot", day))
+    await safe_edit_message(query, text, reply_markup=KB_SLOTS["buildslot", day])
     return STATE_BUILD_SLOT
 
 
 async def on_build_slot(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
-    await query.answer()
+    context.application.create_task(query.answer(), update=update)
 
-    parts = query.data.split(":")
-    if len(parts) >= 3 and parts[1] == "back":
-        await safe_edit_message(query, "Составление. Выберите день (Пн–Пт):", reply_markup=kb_weekdays("buildday"))
+    target = _SLOT_BY_CB.get(query.data)
+    if target is None:
+        await safe_edit_message(query, "Составление. Выберите день (Пн–Пт):", reply_markup=KB_WEEKDAYS["buildday"])
         return STATE_BUILD_DAY
 
-    _, day, slot_index_str = parts
-    slot_index = int(slot_index_str)
+    day, slot_index = target
 
-    context.user_data["build_day"] = day
-    context.user_data["build_slot"] = slot_index
+    context.user_data[K_BDAY] = day
+    context.user_data[K_BSLOT] = slot_index
 
     await safe_edit_message(
         query,
         f"Введите предмет для:\n{WEEKDAY_RU[day]}, {slot_index + 1} пара\n\n"
         "Пример: Математика (ауд. 305)\n"
         "Можно отправить «—», чтобы оставить пусто.",
-        reply_markup=kb_back_to_menu(),
+        reply_markup=KB_BACK,
     )
     return STATE_BUILD_TEXT
 
 
 async def on_build_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     text = (update.message.text or "").strip()
-    day = context.user_data.get("build_day")
-    slot = context.user_data.get("build_slot")
+    day = context.user_data.get(K_BDAY)
+    slot = context.user_data.get(K_BSLOT)
 
     if day not in WEEKDAYS or slot not in range(PAIR_COUNT):
-        await update.message.reply_text("Состояние сбилось. Нажмите /start.", reply_markup=kb_menu())
+        await update.message.reply_text("Состояние сбилось. Нажмите /start.", reply_markup=KB_MENU)
         return STATE_MENU
 
     user_id = update.effective_user.id
-    schedule = set_user_day_slot(user_id, day, slot, text if text else "—")
+    schedule = await set_user_day_slot(user_id, day, slot, text)
 
-    await update.message.reply_text("Сохранено.\n\n" + format_day(schedule, day), reply_markup=kb_menu())
+    await update.message.reply_text("Сохранено.\n\n" + format_day(schedule, day), reply_markup=KB_MENU)
     return STATE_MENU
 
 
 # =========================
-# 12) Edit
+# 13) Edit
 # =========================
 async def on_edit_day(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
-    await query.answer()
+    context.application.create_task(query.answer(), update=update)
 
-    _, day = query.data.split(":", 1)
-    context.user_data["edit_day"] = day
+    day = _DAY_BY_CB[query.data]
+    context.user_data[K_EDAY] = day
 
     user_id = query.from_user.id
-    schedule = get_user_schedule(user_id)
+    schedule = await _get_user_schedule_readonly(user_id)
 
     text = format_day(schedule, day) + "\n\nВыберите пару для редактирования:"
-    await safe_edit_message(query, text, reply_markup=kb_slots("editslot", day))
+    await safe_edit_message(query, text, reply_markup=KB_SLOTS["editslot", day])
     return STATE_EDIT_SLOT
 
 
 async def on_edit_slot(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
-    await query.answer()
+    context.application.create_task(query.answer(), update=update)
 
-    parts = query.data.split(":")
-    if len(parts) >= 3 and parts[1] == "back":
-        await safe_edit_message(query, "Редактирование. Выберите день (Пн–Пт):", reply_markup=kb_weekdays("editday"))
+    target = _SLOT_BY_CB.get(query.data)
+    if target is None:
+        await safe_edit_message(query, "Редактирование. Выберите день (Пн–Пт):", reply_markup=KB_WEEKDAYS["editday"])
         return STATE_EDIT_DAY
 
-    _, day, slot_index_str = parts
-    slot_index = int(slot_index_str)
+    day, slot_index = target
 
-    context.user_data["edit_day"] = day
-    context.user_data["edit_slot"] = slot_index
+    context.user_data[K_EDAY] = day
+    context.user_data[K_ESLOT] = slot_index
 
     user_id = query.from_user.id
-    schedule = get_user_schedule(user_id)
-    current = schedule[day][slot_index]
+    schedule = await _get_user_schedule_readonly(user_id)
+    current = schedule[DAY_IDX[day] + slot_index]
 
     await safe_edit_message(
         query,
         f"Текущее значение:\n{current}\n\n"
         f"Введите новое для:\n{WEEKDAY_RU[day]}, {slot_index + 1} пара\n\n"
         "Можно отправить «—», чтобы очистить.",
-        reply_markup=kb_back_to_menu(),
+        reply_markup=KB_BACK,
     )
     return STATE_EDIT_TEXT
 
 
 async def on_edit_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     text = (update.message.text or "").strip()
-    day = context.user_data.get("edit_day")
-    slot = context.user_data.get("edit_slot")
+    day = context.user_data.get(K_EDAY)
+    slot = context.user_data.get(K_ESLOT)
 
     if day not in WEEKDAYS or slot not in range(PAIR_COUNT):
-        await update.message.reply_text("Состояние сбилось. Нажмите /start.", reply_markup=kb_menu())
+        await update.message.reply_text("Состояние сбилось. Нажмите /start.", reply_markup=KB_MENU)
         return STATE_MENU
 
     user_id = update.effective_user.id
-    schedule = set_user_day_slot(user_id, day, slot, text if text else "—")
+    schedule = await set_user_day_slot(user_id, day, slot, text)
 
-    await update.message.reply_text("Обновлено.\n\n" + format_day(schedule, day), reply_markup=kb_menu())
+    await update.message.reply_text("Обновлено.\n\n" + format_day(schedule, day), reply_markup=KB_MENU)
     return STATE_MENU
 
 
 # =========================
-# 13) Error handler
+# 14) Error handler
 # =========================
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
-    print("Unhandled error:", context.error)
+    log.exception("Unhandled error", exc_info=context.error)
+
+
+# =========================
+# 15) Lifecycle hooks
+# =========================
+async def on_post_init(app) -> None:
+    global _FLUSH_TASK
+    _ensure_db()
+    _FLUSH_TASK = asyncio.create_task(_flusher())
+
+
+async def on_post_shutdown(app) -> None:
+    if _FLUSH_TASK is not None:
+        _FLUSH_TASK.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await _FLUSH_TASK
+    await flush()
+    _close_db()
 
 
 # =========================
-# 14) Main
+# 16) Update processing
+# =========================
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    # Апдейты разных пользователей обрабатываются параллельно, а одного
+    # пользователя — строго по очереди: ConversationHandler меняет состояние
+    # только после возврата из обработчика, и следующий апдейт должен его видеть.
+    # Семафор базового класса слот занимает ещё до ожидания очереди пользователя,
+    # поэтому он отключён, а лимит max_concurrent_updates держит свой семафор,
+    # который берётся уже внутри блокировки пользователя.
+    def __init__(self, max_concurrent_updates: int) -> None:
+        super().__init__(sys.maxsize)
+        self._running = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._locks: Dict[int, Tuple[asyncio.Lock, List[int]]] = {}
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        key = None
+        if isinstance(update, Update):
+            if update.effective_user is not None:
+                key = update.effective_user.id
+            elif update.effective_chat is not None:
+                key = update.effective_chat.id
+        if key is None:
+            async with self._running:
+                await coroutine
+            return
+
+        lock, users = self._locks.setdefault(key, (asyncio.Lock(), [0]))
+        users[0] += 1
+        try:
+            async with lock:
+                async with self._running:
+                    await coroutine
+        finally:
+            users[0] -= 1
+            if not users[0]:
+                del self._locks[key]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
 # =========================
+# 17) Main
+# =========================
+# Шаблоны callback_data компилируются один раз из тех же таблиц CB_*, что и
+# кнопки, и принимают только реальные кнопки (\Z, а не $, чтобы не пропустить
+# хвостовой перевод строки), так что чужие данные отсекаются ещё до входа в обработчик.
+def _cb_pattern(*values: Iterable[str]) -> "re.Pattern[str]":
+    alternatives = "|".join(re.escape(cb) for group in values for cb in group)
+    return re.compile(rf"(?:{alternatives})\Z")
+
+
+P_MENU_BACK = _cb_pattern([CB_MENU_BACK])
+P_VIEWDAY = _cb_pattern(CB_DAYS["viewday"].values())
+P_BUILDDAY = _cb_pattern(CB_DAYS["buildday"].values())
+P_EDITDAY = _cb_pattern(CB_DAYS["editday"].values())
+P_BUILDSLOT = _cb_pattern(CB_SLOTS["buildslot"].values(), CB_SLOTS_BACK["buildslot"].values())
+P_EDITSLOT = _cb_pattern(CB_SLOTS["editslot"].values(), CB_SLOTS_BACK["editslot"].values())
+
+
 def main() -> None:
     if not TOKEN:
         raise RuntimeError("BOT_TOKEN не найден. Проверьте .env (BOT_TOKEN=...).")
 
-    app = ApplicationBuilder().token(TOKEN).build()
+    app = (
+        ApplicationBuilder()
+        .token(TOKEN)
+        .concurrent_updates(PerUserUpdateProcessor(256))
+        .connection_pool_size(256)
+        .pool_timeout(30)
+        .get_updates_connection_pool_size(4)
+        .post_init(on_post_init)
+        .post_shutdown(on_post_shutdown)
+        .build()
+    )
     app.add_error_handler(error_handler)
 
     conv = ConversationHandler(
@@ -388,32 +695,32 @@ def main() -> None:
         states={
             STATE_MENU: [CallbackQueryHandler(on_menu_click)],
             STATE_VIEW_DAY: [
-                CallbackQueryHandler(on_view_day, pattern=r"^viewday:"),
-                CallbackQueryHandler(on_menu_click, pattern=r"^menu:back$"),
+                CallbackQueryHandler(on_view_day, pattern=P_VIEWDAY),
+                CallbackQueryHandler(on_menu_click, pattern=P_MENU_BACK),
             ],
             STATE_BUILD_DAY: [
-                CallbackQueryHandler(on_build_day, pattern=r"^buildday:"),
-                CallbackQueryHandler(on_menu_click, pattern=r"^menu:back$"),
+                CallbackQueryHandler(on_build_day, pattern=P_BUILDDAY),
+                CallbackQueryHandler(on_menu_click, pattern=P_MENU_BACK),
             ],
             STATE_BUILD_SLOT: [
-                CallbackQueryHandler(on_build_slot, pattern=r"^buildslot:"),
-                CallbackQueryHandler(on_menu_click, pattern=r"^menu:back$"),
+                CallbackQueryHandler(on_build_slot, pattern=P_BUILDSLOT),
+                CallbackQueryHandler(on_menu_click, pattern=P_MENU_BACK),
             ],
             STATE_BUILD_TEXT: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, on_build_text),
-                CallbackQueryHandler(on_menu_click, pattern=r"^menu:back$"),
+                CallbackQueryHandler(on_menu_click, pattern=P_MENU_BACK),
             ],
             STATE_EDIT_DAY: [
-                CallbackQueryHandler(on_edit_day, pattern=r"^editday:"),
-                CallbackQueryHandler(on_menu_click, pattern=r"^menu:back$"),
+                CallbackQueryHandler(on_edit_day, pattern=P_EDITDAY),
+                CallbackQueryHandler(on_menu_click, pattern=P_MENU_BACK),
             ],
             STATE_EDIT_SLOT: [
-                CallbackQueryHandler(on_edit_slot, pattern=r"^editslot:"),
-                CallbackQueryHandler(on_menu_click, pattern=r"^menu:back$"),
+                CallbackQueryHandler(on_edit_slot, pattern=P_EDITSLOT),
+                CallbackQueryHandler(on_menu_click, pattern=P_MENU_BACK),
             ],
             STATE_EDIT_TEXT: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, on_edit_text),
-                CallbackQueryHandler(on_menu_click, pattern=r"^menu:back$"),
+                CallbackQueryHandler(on_menu_click, pattern=P_MENU_BACK),
             ],
         },
         fallbacks=[CommandHandler("help", cmd_help)],
@@ -425,8 +732,26 @@ def main() -> None:
     app.add_handler(conv)
     app.add_handler(CommandHandler("help", cmd_help))
 
-    print("Bot started (multi-user schedules)...")
-    app.run_polling()
+    _LOG_LISTENER.start()
+    try:
+        if "--dev" in sys.argv or not WEBHOOK_URL:
+            log.info("Bot started (multi-user schedules, polling)...")
+            app.run_polling()
+            return
+
+        port = int(os.getenv("PORT", "8443"))
+        log.info("Bot started (multi-user schedules, webhook)...")
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=port,
+            url_path=TOKEN,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{TOKEN}",
+            drop_pending_updates=True,
+            max_connections=100,
+            secret_token=WEBHOOK_SECRET,
+        )
+    finally:
+        _LOG_LISTENER.stop()
 
 
 if __name__ == "__main__":